@@ -1,25 +1,102 @@
 import os
-import json
+import orjson
 import logging
 import base64
-import psycopg2
-from datetime import datetime
+import random
+import time
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from psycopg.conninfo import conninfo_to_dict
+from psycopg_pool import ConnectionPool
+import requests
+from requests.adapters import HTTPAdapter
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Gmail users.watch endpoint, called directly instead of through the discovery client
+GMAIL_WATCH_URL = "https://gmail.googleapis.com/gmail/v1/users/me/watch"
+GMAIL_REQUEST_TIMEOUT = 10
+
+# Gmail API responses worth retrying in-process (rate limits and transient errors).
+# GMAIL_RENEWAL_DEADLINE bounds the total time one renewal may take, across
+# retries, sleeps and the 401 token refresh, well inside the worker's 300s timeout.
+RETRYABLE_STATUSES = (429, 500, 503)
+MAX_RETRY_ATTEMPTS = 3
+MAX_RETRY_DELAY = 20
+GMAIL_RENEWAL_DEADLINE = 90
+
+# Maximum concurrent Gmail API renewals within one batched message
+MAX_RENEWAL_WORKERS = 20
+
+# One HTTPS session shared by all Gmail calls on the instance, so connections
+# are reused across users; per-user credentials are applied to each request
+_gmail_session = requests.Session()
+_gmail_session.mount('https://', HTTPAdapter(pool_maxsize=MAX_RENEWAL_WORKERS))
+# Token refreshes use the same session, with the Gmail timeout instead of google-auth's 120s default
+_auth_request = functools.partial(Request(session=_gmail_session), timeout=GMAIL_REQUEST_TIMEOUT)
+
+# PostgreSQL connection pool reused across invocations on a warm instance.
+# PG_POOL_MAX should match the Cloud Run --concurrency setting.
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_connection_kwargs(database_url):
+    """
+    Connection defaults, applied only where DATABASE_URL (or libpq's
+    PGSSLMODE) doesn't already set them, so a stricter sslmode such as
+    verify-full is never downgraded
+    """
+    params = conninfo_to_dict(database_url)
+    kwargs = {'autocommit': False}
+    
+    if 'sslmode' not in params and not os.getenv('PGSSLMODE'):
+        kwargs['sslmode'] = 'require'
+    if 'keepalives' not in params:
+        kwargs['keepalives'] = 1
+    
+    return kwargs
+
+def get_connection_pool(database_url):
+    """
+    Lazily create the module-level PostgreSQL connection pool
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    conninfo=database_url,
+                    min_size=1,
+                    max_size=int(os.getenv('PG_POOL_MAX', '4')),
+                    kwargs=get_connection_kwargs(database_url),
+                    open=True
+                )
+    return _pool
+
+# Watch UPDATE run for every renewal; pipelined executemany prepares it
+# server-side on first use per pooled connection
+UPDATE_WATCH_QUERY = '''
+UPDATE gmail_mailbox_watches 
+SET 
+    history_id = %s,
+    watch_expiration = to_timestamp(%s::bigint / 1000.0)
+WHERE account_id = %s AND is_active = true
+RETURNING account_id
+'''
+
 def renewal_worker_function(event, context):
     """
     Cloud Run Function entry point for Gmail watch renewal worker
     Triggered by Pub/Sub messages from gmail-watch-renewal topic
     
     This function:
-    1. Receives individual watch renewal request from Pub/Sub
-    2. Calls Gmail API to renew the watch
+    1. Receives a watch renewal request (or a batch of them) from Pub/Sub
+    2. Calls Gmail API to renew the watch(es)
     3. Updates database with new watch details
     """
     try:
@@ -28,16 +105,29 @@ def renewal_worker_function(event, context):
             logger.error("No data in Pub/Sub message")
             return
         
-        message_data = base64.b64decode(event['data']).decode('utf-8')
-        renewal_request = json.loads(message_data)
+        # Message type travels as a Pub/Sub attribute
+        attributes = event.get('attributes') or {}
+        
+        # Some runtimes deliver the payload already decoded to bytes or a dict
+        message_data = event['data']
+        if isinstance(message_data, (dict, list)):
+            payload = message_data
+        else:
+            if isinstance(message_data, str):
+                message_data = base64.b64decode(message_data)
+            payload = orjson.loads(message_data)
+        
+        # renew_batch data is the bare list of watches to renew
+        if attributes.get('action') == 'renew_batch':
+            process_renewal_batch(payload)
+            return
+        
+        renewal_request = payload
         
         logger.info(f"Processing Gmail watch renewal for user {renewal_request.get('user_id')} ({renewal_request.get('email')})")
         
         # Validate required fields
-        required_fields = ['account_id', 'user_id', 'email', 'access_token', 'refresh_token']
-        for field in required_fields:
-            if field not in renewal_request:
-                raise ValueError(f"Missing required field: {field}")
+        validate_renewal_request(renewal_request)
         
         # Renew Gmail watch
         renewal_result = renew_gmail_watch(
@@ -64,52 +154,240 @@ def renewal_worker_function(event, context):
         # Don't re-raise - acknowledge the message to prevent infinite retries
         # In production, you might want to send to a dead letter queue
 
-def renew_gmail_watch(access_token, refresh_token):
+def process_renewal_batch(renewal_requests):
     """
-    Renew Gmail watch using the Gmail API
+    Renew a batch of Gmail watches and update the database for each success
+    
+    Args:
+        renewal_requests (list): Renewal requests carried by a renew_batch message
+    """
+    logger.info(f"Processing Gmail watch renewal batch of {len(renewal_requests)} watches")
+    
+    # Skip malformed entries instead of failing the whole batch
+    valid_requests = []
+    for renewal_request in renewal_requests:
+        try:
+            validate_renewal_request(renewal_request)
+            valid_requests.append(renewal_request)
+        except ValueError as e:
+            logger.error(f"Skipping renewal for user {renewal_request.get('user_id')}: {str(e)}")
+    
+    if not valid_requests:
+        return
+    
+    renewal_results = renew_gmail_watches_batch(valid_requests)
+    
+    renewed_rows = []
+    for renewal_request, renewal_result in zip(valid_requests, renewal_results):
+        if renewal_result.get('success'):
+            # Skip a bad row rather than losing the rest of the batch
+            try:
+                expiration_ms = int(renewal_result['expiration'])
+            except (KeyError, TypeError, ValueError):
+                logger.error(f"Renewed Gmail watch for user {renewal_request['user_id']} but got invalid expiration: {renewal_result.get('expiration')!r}")
+                continue
+            
+            renewed_rows.append((
+                renewal_request['account_id'],
+                renewal_result['history_id'],
+                expiration_ms
+            ))
+            
+            logger.info(f"Successfully renewed Gmail watch for user {renewal_request['user_id']}")
+        else:
+            logger.error(f"Failed to renew Gmail watch for user {renewal_request['user_id']}: {renewal_result.get('error')}")
+    
+    # Store every renewal from the batch in a single transaction
+    if renewed_rows:
+        update_watch_batch_in_database(renewed_rows)
+
+def validate_renewal_request(renewal_request):
+    """
+    Ensure a renewal request carries every field needed to renew the watch
+    """
+    required_fields = ['account_id', 'user_id', 'email', 'access_token', 'refresh_token']
+    for field in required_fields:
+        if field not in renewal_request:
+            raise ValueError(f"Missing required field: {field}")
+
+def get_gmail_settings():
+    """
+    Read Gmail renewal settings from environment variables
+    
+    Returns:
+        dict: project_id, email_reply_topic, client_id and client_secret
+    """
+    settings = {
+        'project_id': os.getenv('GCP_PROJECT_ID'),
+        'email_reply_topic': os.getenv('GCP_PUB_SUB_EMAIL_REPLY_TOPIC_ID'),
+        'client_id': os.getenv('GOOGLE_CLIENT_ID'),
+        'client_secret': os.getenv('GOOGLE_CLIENT_SECRET')
+    }
+    
+    # Check required variables (email_reply_topic is optional)
+    if not all([settings['project_id'], settings['client_id'], settings['client_secret']]):
+        raise ValueError("Missing required environment variables")
+    
+    return settings
+
+@functools.lru_cache(maxsize=256)
+def get_credentials(client_id, client_secret, refresh_token):
+    """
+    Return OAuth2 credentials cached per refresh token for the life of the instance
+    
+    Refreshed access tokens stay on the cached credentials, so repeated
+    renewals for the same user don't each pay a token refresh.
+    """
+    return Credentials(
+        token=None,
+        refresh_token=refresh_token,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=client_id,
+        client_secret=client_secret,
+        scopes=[
+            'https://www.googleapis.com/auth/gmail.readonly',
+            'https://www.googleapis.com/auth/gmail.send'
+        ]
+    )
+
+def get_user_credentials(access_token, refresh_token, settings):
+    """
+    Get the cached OAuth2 credentials for a user
+    """
+    credentials = get_credentials(settings['client_id'], settings['client_secret'], refresh_token)
+    
+    # Seed new credentials with the caller's access token to skip an upfront refresh;
+    # an expired token is refreshed on the first 401
+    if credentials.token is None:
+        credentials.token = access_token
+    
+    return credentials
+
+def post_watch_request(credentials, watch_request, timeout):
+    """
+    POST users.watch on the shared session with the user's credentials applied
     """
+    headers = {}
+    credentials.before_request(_auth_request, 'POST', GMAIL_WATCH_URL, headers)
+    
+    return _gmail_session.post(
+        GMAIL_WATCH_URL,
+        json=watch_request,
+        headers=headers,
+        timeout=timeout
+    )
+
+def get_retry_delay(response, attempt):
+    """
+    Seconds to wait before retrying, honoring a numeric Retry-After
+    
+    Args:
+        response: Retryable Gmail API response, or None after a connection error
+        attempt (int): Zero-based attempt number that failed
+    
+    Returns:
+        float: Delay in seconds, capped at MAX_RETRY_DELAY
+    """
+    retry_after = response.headers.get('Retry-After') if response is not None else None
     try:
-        # Get environment variables
-        project_id = os.getenv('GCP_PROJECT_ID')
-        email_reply_topic = os.getenv('GCP_PUB_SUB_EMAIL_REPLY_TOPIC_ID')
-        client_id = os.getenv('GOOGLE_CLIENT_ID')
-        client_secret = os.getenv('GOOGLE_CLIENT_SECRET')
-        
-        # Check required variables (email_reply_topic is optional)
-        if not all([project_id, client_id, client_secret]):
-            raise ValueError("Missing required environment variables")
-        
-        # Create Gmail API client
-        credentials = Credentials(
-            token=access_token,
-            refresh_token=refresh_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=client_id,
-            client_secret=client_secret,
-            scopes=[
-                'https://www.googleapis.com/auth/gmail.readonly',
-                'https://www.googleapis.com/auth/gmail.send'
-            ]
-        )
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        # Exponential backoff with jitter (also used for HTTP-date Retry-After)
+        delay = 2 ** attempt + random.uniform(0, 1)
+    
+    return min(delay, MAX_RETRY_DELAY)
+
+def execute_watch_request(credentials, watch_request):
+    """
+    Call users.watch, retrying rate limits, transient errors and one stale token
+    
+    Every attempt, sleep and the token refresh share one GMAIL_RENEWAL_DEADLINE,
+    so a renewal gives up (returning the last response or raising) instead of
+    running past the Cloud Run timeout.
+    """
+    deadline = time.monotonic() + GMAIL_RENEWAL_DEADLINE
+    attempt = 0
+    refreshed = False
+    
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout("Gmail watch renewal deadline exceeded")
         
-        service = build('gmail', 'v1', credentials=credentials)
+        timeout = min(GMAIL_REQUEST_TIMEOUT, remaining)
+        try:
+            response = post_watch_request(credentials, watch_request, timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            response = None
+            if attempt >= MAX_RETRY_ATTEMPTS:
+                raise
         
-        # Setup watch request - only include topic if provided
-        watch_request = {
-            'labelIds': ['INBOX'],
-            'labelFilterAction': 'include'
-        }
+        if response is not None and response.status_code == 401 and not refreshed:
+            # Access token was stale; refresh it and try once more
+            credentials.refresh(_auth_request)
+            refreshed = True
+            continue
         
-        # Add topic only if email_reply_topic is provided
-        if email_reply_topic:
-            topic_name = f"projects/{project_id}/topics/{email_reply_topic}"
-            watch_request['topicName'] = topic_name
-            logger.info(f"Setting up Gmail watch with topic: {topic_name}")
-        else:
-            logger.info("Setting up Gmail watch without topic (expiration monitoring only)")
+        if response is not None and (response.status_code not in RETRYABLE_STATUSES or attempt >= MAX_RETRY_ATTEMPTS):
+            return response
+        
+        delay = get_retry_delay(response, attempt)
+        # Leave room for at least one more request before the deadline
+        if time.monotonic() + delay + 1 >= deadline:
+            if response is None:
+                raise requests.Timeout("Gmail watch renewal deadline exceeded")
+            return response
+        
+        logger.warning(f"Gmail API call failed ({response.status_code if response is not None else 'connection error'}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
+
+def create_watch_request(settings):
+    """
+    Build the users.watch request body - only include topic if provided
+    """
+    watch_request = {
+        'labelIds': ['INBOX'],
+        'labelFilterAction': 'include'
+    }
+    
+    # Add topic only if email_reply_topic is provided
+    if settings['email_reply_topic']:
+        topic_name = f"projects/{settings['project_id']}/topics/{settings['email_reply_topic']}"
+        watch_request['topicName'] = topic_name
+        logger.info(f"Setting up Gmail watch with topic: {topic_name}")
+    else:
+        logger.info("Setting up Gmail watch without topic (expiration monitoring only)")
+    
+    return watch_request
+
+def renew_gmail_watch(access_token, refresh_token):
+    """
+    Renew Gmail watch using the Gmail API
+    """
+    try:
+        settings = get_gmail_settings()
+        watch_request = create_watch_request(settings)
+    except Exception as e:
+        logger.error(f"Failed to renew Gmail watch: {str(e)}")
+        return {
+            'success': False,
+            'error': f"Failed to renew Gmail watch: {str(e)}"
+        }
+    
+    return send_watch_request(access_token, refresh_token, settings, watch_request)
+
+def send_watch_request(access_token, refresh_token, settings, watch_request):
+    """
+    Call users.watch for one user with already-built settings and request body
+    """
+    try:
+        credentials = get_user_credentials(access_token, refresh_token, settings)
         
         # Call the Gmail API watch method
-        result = service.users().watch(userId='me', body=watch_request).execute()
+        response = execute_watch_request(credentials, watch_request)
+        response.raise_for_status()
+        result = response.json()
         
         logger.info(f"Gmail watch renewal successful: {result}")
         
@@ -119,7 +397,7 @@ def renew_gmail_watch(access_token, refresh_token):
             'expiration': result.get('expiration')
         }
         
-    except HttpError as e:
+    except requests.HTTPError as e:
         logger.error(f"Gmail API error during renewal: {str(e)}")
         return {
             'success': False,
@@ -132,44 +410,93 @@ def renew_gmail_watch(access_token, refresh_token):
             'error': f"Failed to renew Gmail watch: {str(e)}"
         }
 
+def renew_gmail_watches_batch(renewal_requests):
+    """
+    Renew several Gmail watches concurrently
+    
+    Gmail API calls are network-bound, so a thread pool overlaps their round
+    trips while each watch keeps its own retry handling. Different users draw
+    on separate Gmail quota buckets.
+    
+    Args:
+        renewal_requests (list): Validated renewal requests
+    
+    Returns:
+        list: Renewal results in the same order as renewal_requests, shaped like renew_gmail_watch()
+    """
+    # Settings and the watch body are the same for every user in the batch
+    try:
+        settings = get_gmail_settings()
+        watch_request = create_watch_request(settings)
+    except Exception as e:
+        logger.error(f"Failed to renew Gmail watch batch: {str(e)}")
+        return [
+            {
+                'success': False,
+                'error': f"Failed to renew Gmail watch: {str(e)}"
+            }
+            for _ in renewal_requests
+        ]
+    
+    max_workers = min(MAX_RENEWAL_WORKERS, len(renewal_requests))
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda renewal_request: send_watch_request(
+                renewal_request['access_token'],
+                renewal_request['refresh_token'],
+                settings,
+                watch_request
+            ),
+            renewal_requests
+        ))
+
 def update_watch_in_database(account_id, history_id, expiration_ms):
     """
     Update Gmail watch details in the database
     """
+    update_watch_batch_in_database([(account_id, history_id, expiration_ms)])
+
+def update_watch_batch_in_database(rows):
+    """
+    Update several Gmail watches in the database in one pipelined round trip
+    
+    Pipeline mode sends every UPDATE without waiting for the previous result.
+    All rows share a single transaction, committed once when the pooled
+    connection block exits and rolled back if any UPDATE fails.
+    
+    Args:
+        rows (list): Tuples of (account_id, history_id, expiration_ms)
+    """
     try:
         database_url = os.getenv('DATABASE_URL')
         if not database_url:
             raise ValueError("Missing DATABASE_URL environment variable")
         
-        conn = psycopg2.connect(database_url)
-        
-        # Convert expiration from milliseconds to datetime
-        expiration_dt = datetime.fromtimestamp(int(expiration_ms) / 1000)
-        
-        with conn.cursor() as cursor:
-            cursor.execute(
-                '''
-                UPDATE gmail_mailbox_watches 
-                SET 
-                    history_id = %s,
-                    watch_expiration = %s
-                WHERE account_id = %s AND is_active = true
-                ''',
-                (history_id, expiration_dt, account_id)
+        pool = get_connection_pool(database_url)
+        
+        with pool.connection() as conn, conn.pipeline(), conn.cursor() as cursor:
+            cursor.executemany(
+                UPDATE_WATCH_QUERY,
+                [(history_id, int(expiration_ms), account_id) for account_id, history_id, expiration_ms in rows],
+                returning=True
             )
             
-            if cursor.rowcount > 0:
-                conn.commit()
-                logger.info(f"Updated Gmail watch in database: account_id={account_id}, history_id={history_id}, expiration={expiration_dt}")
-            else:
-                logger.warning(f"No active Gmail watch found for account_id={account_id}")
+            # One result set per row, in order
+            updated_count = 0
+            for account_id, history_id, expiration_ms in rows:
+                if cursor.fetchone() is not None:
+                    updated_count += 1
+                    logger.info(f"Updated Gmail watch in database: account_id={account_id}, history_id={history_id}, expiration_ms={expiration_ms}")
+                else:
+                    logger.warning(f"No active Gmail watch found for account_id={account_id}")
+                cursor.nextset()
+        
+        logger.info(f"Updated {updated_count} Gmail watches in database")
         
     except Exception as e:
-        logger.error(f"Failed to update watch in database: {str(e)}")
+        logger.error(f"Failed to update watches in database: {str(e)}")
         raise
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 # Cloud Run entry point
 if __name__ == "__main__":
@@ -1,8 +1,15 @@
 import os
 import json
 import logging
-import psycopg2
-from datetime import datetime, timedelta
+import orjson
+import threading
+from psycopg.rows import dict_row
+from psycopg.conninfo import conninfo_to_dict
+from psycopg_pool import ConnectionPool
+from itertools import chain, islice
+from functools import partial
+from concurrent import futures
+from datetime import datetime
 from google.cloud import pubsub_v1
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
@@ -12,6 +19,96 @@ from googleapiclient.errors import HttpError
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pub/Sub publisher reused across invocations on a warm instance.
+# Batching lets the client pack many renewal messages into a single Publish RPC.
+_publisher = None
+_publisher_lock = threading.Lock()
+_topic_paths = {}
+
+def get_publisher():
+    """
+    Lazily create the module-level Pub/Sub publisher client
+    """
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = pubsub_v1.PublisherClient(
+                    batch_settings=pubsub_v1.types.BatchSettings(
+                        max_messages=int(os.getenv('PS_BATCH_MSGS', '1000')),
+                        max_bytes=int(os.getenv('PS_BATCH_BYTES', '9500000')),
+                        max_latency=float(os.getenv('PS_BATCH_LATENCY', '0.05'))
+                    ),
+                    # Block instead of failing when a large tick outpaces the publisher
+                    publisher_options=pubsub_v1.types.PublisherOptions(
+                        flow_control=pubsub_v1.types.PublishFlowControl(
+                            message_limit=5000,
+                            byte_limit=100 * 1024 * 1024,
+                            limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK
+                        )
+                    )
+                )
+    return _publisher
+
+def get_topic_path(publisher, project_id, topic_id):
+    """
+    Return the cached fully qualified topic path for a project and topic
+    """
+    key = (project_id, topic_id)
+    if key not in _topic_paths:
+        _topic_paths[key] = publisher.topic_path(project_id, topic_id)
+    return _topic_paths[key]
+
+# Maximum watches per renewal message (the worker renews them concurrently)
+RENEWAL_BATCH_SIZE = 20
+
+# Fields forwarded per watch; the renewal worker requires all but watch_id
+RENEWAL_FIELDS = ('account_id', 'user_id', 'email', 'watch_id', 'access_token', 'refresh_token')
+
+# Upper bound on watches renewed per scheduler tick
+MAX_EXPIRING_WATCHES = int(os.getenv('MAX_EXPIRING_WATCHES', '10000'))
+
+# Seconds to wait for queued publishes before returning the HTTP response
+PUBLISH_WAIT_TIMEOUT = 5
+
+# PostgreSQL connection pool reused across invocations on a warm instance.
+# PG_POOL_MAX should match the Cloud Run --concurrency setting.
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_connection_kwargs(database_url):
+    """
+    Connection defaults, applied only where DATABASE_URL (or libpq's
+    PGSSLMODE) doesn't already set them, so a stricter sslmode such as
+    verify-full is never downgraded
+    """
+    params = conninfo_to_dict(database_url)
+    kwargs = {'autocommit': False}
+    
+    if 'sslmode' not in params and not os.getenv('PGSSLMODE'):
+        kwargs['sslmode'] = 'require'
+    if 'keepalives' not in params:
+        kwargs['keepalives'] = 1
+    
+    return kwargs
+
+def get_connection_pool(database_url):
+    """
+    Lazily create the module-level PostgreSQL connection pool
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    conninfo=database_url,
+                    min_size=1,
+                    max_size=int(os.getenv('PG_POOL_MAX', '4')),
+                    kwargs=get_connection_kwargs(database_url),
+                    open=True
+                )
+    return _pool
+
 def watch_query_function(request):
     """
     Cloud Run Function entry point for Gmail watch query
@@ -33,10 +130,11 @@ def watch_query_function(request):
         if not all([project_id, topic_id, database_url]):
             raise ValueError("Missing required environment variables")
         
-        # Query expiring watches (within 24 hours)
-        expiring_watches = get_expiring_watches(database_url, hours_ahead=24)
+        # Stream expiring watches (within 24 hours) straight into the publisher
+        watch_stream = get_expiring_watches(database_url, hours_ahead=24)
         
-        if not expiring_watches:
+        first_watch = next(watch_stream, None)
+        if first_watch is None:
             logger.info("No Gmail watches expiring within 24 hours found")
             return {
                 'statusCode': 200,
@@ -47,25 +145,23 @@ def watch_query_function(request):
                 })
             }
         
-        # Log accounts approaching expiration
-        for watch in expiring_watches:
-            expiration_time = datetime.fromisoformat(watch['expiration_time'].replace('Z', '+00:00'))
-            time_until_expiry = expiration_time - datetime.utcnow().replace(tzinfo=expiration_time.tzinfo)
-            hours_remaining = time_until_expiry.total_seconds() / 3600
-            
-            logger.warning(f"Account {watch['email']} (user_id: {watch['user_id']}) has Gmail watch expiring in {hours_remaining:.1f} hours at {watch['expiration_time']}")
+        expiring_watches = log_expiring_watches(chain([first_watch], watch_stream))
         
         # Publish renewal messages to Pub/Sub
-        published_count = publish_renewal_messages(project_id, topic_id, expiring_watches)
+        try:
+            queued_count = publish_renewal_messages(project_id, topic_id, expiring_watches)
+        finally:
+            # Release the database connection even if publishing stops early
+            watch_stream.close()
         
-        logger.info(f"Published {published_count} renewal messages")
+        logger.info(f"Queued renewal messages for {queued_count} watches")
         
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'success': True,
-                'message': f'Published {published_count} renewal messages',
-                'watches_processed': published_count
+                'message': f'Queued renewal messages for {queued_count} watches',
+                'watches_processed': queued_count
             })
         }
         
@@ -79,52 +175,71 @@ def watch_query_function(request):
             })
         }
 
+def log_expiring_watches(watches):
+    """
+    Log accounts approaching expiration as they stream through
+    
+    Args:
+        watches (iterable): Expiring watch records
+    
+    Yields:
+        dict: The same watch records, unchanged
+    """
+    for watch in watches:
+        expiration_time = datetime.fromisoformat(watch['expiration_time'].replace('Z', '+00:00'))
+        time_until_expiry = expiration_time - datetime.utcnow().replace(tzinfo=expiration_time.tzinfo)
+        hours_remaining = time_until_expiry.total_seconds() / 3600
+        
+        logger.warning(f"Account {watch['email']} (user_id: {watch['user_id']}) has Gmail watch expiring in {hours_remaining:.1f} hours at {watch['expiration_time']}")
+        
+        yield watch
+
 def get_expiring_watches(database_url, hours_ahead=24):
     """
     Query database for Gmail watches expiring within specified hours
     
+    Rows are streamed through a server-side cursor, so the pooled connection
+    stays checked out until the generator is exhausted or closed.
+    
     Args:
         database_url (str): PostgreSQL connection string
         hours_ahead (int): Hours ahead to check for expiring watches (default: 24 hours)
     
-    Returns:
-        list: List of expiring watch records
+    Yields:
+        dict: Expiring watch record
     """
     try:
-        # Calculate expiration threshold
-        expiration_threshold = datetime.utcnow() + timedelta(hours=hours_ahead)
-        
-        # Connect to database
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        
-        # Query for expiring watches
-        query = """
-        SELECT user_id, email, watch_id, expiration_time
-        FROM gmail_watches 
-        WHERE expiration_time <= %s 
-        AND is_active = true
-        ORDER BY expiration_time ASC
-        """
-        
-        cursor.execute(query, (expiration_threshold,))
-        watches = cursor.fetchall()
-        
-        # Convert to list of dictionaries
-        watch_list = []
-        for watch in watches:
-            watch_list.append({
-                'user_id': watch[0],
-                'email': watch[1],
-                'watch_id': watch[2],
-                'expiration_time': watch[3].isoformat() if watch[3] else None
-            })
+        pool = get_connection_pool(database_url)
         
-        cursor.close()
-        conn.close()
+        # Check out a pooled database connection; a named cursor keeps the
+        # result set on the server and fetches it in chunks
+        with pool.connection() as conn, conn.cursor(name='expiring_watches', row_factory=dict_row) as cursor:
+            cursor.itersize = 1000
+            
+            # Query for expiring watches - the threshold is computed from the database clock.
+            # Served by: CREATE INDEX ON gmail_watches (expiration_time) WHERE is_active
+            query = """
+            SELECT account_id, user_id, email, watch_id, access_token, refresh_token, expiration_time
+            FROM gmail_watches 
+            WHERE expiration_time <= NOW() + %s::interval 
+            AND is_active = true
+            ORDER BY expiration_time ASC
+            LIMIT %s
+            """
+            
+            cursor.execute(query, (f"{hours_ahead} hours", MAX_EXPIRING_WATCHES))
+            
+            watch_count = 0
+            for watch in cursor:
+                expiration_time = watch['expiration_time']
+                watch['expiration_time'] = expiration_time.isoformat() if expiration_time else None
+                watch_count += 1
+                yield watch
+        
+        logger.info(f"Found {watch_count} expiring watches")
         
-        logger.info(f"Found {len(watch_list)} expiring watches")
-        return watch_list
+        if watch_count >= MAX_EXPIRING_WATCHES:
+            logger.warning(f"Expiring watches reached the MAX_EXPIRING_WATCHES cap of {MAX_EXPIRING_WATCHES}; remaining watches are skipped this tick and may expire before the next one")
         
     except Exception as e:
         logger.error(f"Database query error: {str(e)}")
@@ -134,46 +249,84 @@ def publish_renewal_messages(project_id, topic_id, watches):
     """
     Publish renewal messages to Pub/Sub topic
     
+    Watches are grouped into renew_batch messages of up to RENEWAL_BATCH_SIZE
+    so the worker can renew them concurrently within one invocation. The
+    message data is the JSON watch list; action and timestamp are attributes.
+    
     Args:
         project_id (str): GCP project ID
         topic_id (str): Pub/Sub topic ID
-        watches (list): List of expiring watches
+        watches (iterable): Expiring watches, consumed as they arrive
     
     Returns:
-        int: Number of messages published
+        int: Number of watches queued for publishing
     """
     try:
-        publisher = pubsub_v1.PublisherClient()
-        topic_path = publisher.topic_path(project_id, topic_id)
-        
-        published_count = 0
-        
-        for watch in watches:
-            # Create renewal message
-            message_data = {
-                'user_id': watch['user_id'],
-                'email': watch['email'],
-                'watch_id': watch['watch_id'],
-                'action': 'renew_watch',
-                'timestamp': datetime.utcnow().isoformat()
-            }
-            
-            # Publish message
-            message_json = json.dumps(message_data)
-            future = publisher.publish(topic_path, message_json.encode('utf-8'))
+        publisher = get_publisher()
+        topic_path = get_topic_path(publisher, project_id, topic_id)
+        
+        watches = iter(watches)
+        queued_count = 0
+        publish_futures = []
+        
+        # Every message from this scheduler tick shares the same timestamp
+        timestamp = datetime.utcnow().isoformat()
+        publish = publisher.publish
+        
+        while True:
+            batch = list(islice(watches, RENEWAL_BATCH_SIZE))
+            if not batch:
+                break
             
-            # Wait for publish to complete
-            message_id = future.result()
-            logger.info(f"Published renewal message {message_id} for user {watch['user_id']}")
+            # Only the watch list is JSON; small scalar fields travel as
+            # Pub/Sub attributes, which the worker receives pre-parsed
+            message_data = [
+                {field: watch[field] for field in RENEWAL_FIELDS}
+                for watch in batch
+            ]
             
-            published_count += 1
+            # Queue message - the client batches publishes in the background
+            future = publish(
+                topic_path,
+                orjson.dumps(message_data),
+                action='renew_batch',
+                timestamp=timestamp
+            )
+            future.add_done_callback(partial(log_publish_result, len(batch)))
+            publish_futures.append(future)
+            queued_count += len(batch)
         
-        return published_count
+        # Give in-flight publishes a bounded window to flush before responding,
+        # since Cloud Run throttles CPU once the request has returned
+        done, not_done = futures.wait(publish_futures, timeout=PUBLISH_WAIT_TIMEOUT)
+        if not_done:
+            logger.warning(f"{len(not_done)} renewal messages still publishing after {PUBLISH_WAIT_TIMEOUT}s")
+        
+        # Fail the request so Cloud Scheduler retries the tick
+        failed_count = sum(1 for future in done if future.exception() is not None)
+        if failed_count:
+            raise RuntimeError(f"{failed_count} of {len(publish_futures)} renewal messages failed to publish")
+        
+        return queued_count
         
     except Exception as e:
         logger.error(f"Pub/Sub publish error: {str(e)}")
         raise
 
+def log_publish_result(batch_size, future):
+    """
+    Log the outcome of a renewal message publish once it completes
+    
+    Args:
+        batch_size (int): Number of watches carried by the message
+        future: Pub/Sub publish future
+    """
+    try:
+        message_id = future.result()
+        logger.info(f"Published renewal message {message_id} for {batch_size} watches")
+    except Exception as e:
+        logger.error(f"Failed to publish renewal message for {batch_size} watches: {str(e)}")
+
 # Cloud Run entry point
 if __name__ == "__main__":
     import functions_framework